@@ -1,33 +1,147 @@
 import boto3
+import codecs
 import csv
+import hashlib
+import heapq
 import os
+import signal
+import sys
 import time
 import argparse
+import bisect
+import base64
+import binascii
+from array import array
+from collections import Counter
+import io
+import json
+import queue
+import tempfile
+import threading
+import urllib.parse
+import uuid
+import zlib
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 # Configuración de argparse para obtener parámetros
 parser = argparse.ArgumentParser(description='Script para ejecutar la ingesta de datos')
 
-# Parámetros de entrada
-parser.add_argument('--stage', required=True, help="Indica el stage (por ejemplo, dev, prod)")
-parser.add_argument('--bucket', required=True, help="Indica el nombre del bucket S3")
+# Parámetros de entrada (--stage y --bucket se pueden repetir para procesar varios stages)
+parser.add_argument('--stage', required=True, action='append', help="Indica el stage (por ejemplo, dev, prod). Se puede repetir")
+parser.add_argument('--bucket', required=True, action='append', help="Indica el nombre del bucket S3 (uno por cada --stage)")
+parser.add_argument('--max-stages', type=int, default=3, help="Número máximo de stages procesados en paralelo")
+parser.add_argument('--workers-por-stage', type=int, default=4, help="Número máximo de segmentos de scan en paralelo por stage")
+parser.add_argument('--cdc', action='store_true', help="Consume el DynamoDB Stream de la tabla y publica micro-lotes en S3")
+parser.add_argument('--cdc-intervalo', type=int, default=60, help="Segundos máximos entre micro-lotes del modo --cdc")
+parser.add_argument('--cdc-max-filas', type=int, default=10000, help="Filas máximas por micro-lote del modo --cdc")
+parser.add_argument('--cdc-duracion', type=int, help="Segundos que corre el modo --cdc (por defecto, hasta interrumpirlo)")
+parser.add_argument('--compactar', action='store_true', help="Fusiona los deltas en un nuevo snapshot base y apunta la tabla de Glue a él")
+parser.add_argument('--memoria-mb', type=int, default=256, help="Memoria máxima que usan --compactar por partición y el índice de claves al ordenar")
+parser.add_argument('--detectar-borrados', action='store_true', help="Compara las claves actuales con el índice de la ejecución anterior y publica tombstones")
+parser.add_argument('--versiones-retenidas', type=int, default=3, help="Versiones anteriores que se conservan en S3 para poder revertir")
+parser.add_argument('--rollback', action='store_true', help="Apunta la tabla de Glue a la versión anterior a la publicada")
+parser.add_argument('--profile', action='store_true', help="Perfila la ejecución (muestreo de pilas y tiempos por página de cada etapa)")
+parser.add_argument('--profile-intervalo', type=float, default=5, help="Milisegundos entre muestras del modo --profile")
+parser.add_argument('--profile-dir', default='perfil', help="Directorio local donde se escribe el perfil")
+parser.add_argument('--redividir-rezagados', action='store_true', help="Re-divide los segmentos rezagados entre los workers libres. Supone que cada segmento de scan cubre un rango de hash contiguo (como en DynamoDB); si no, se duplican filas")
+parser.add_argument('--rezagado-factor', type=float, default=2, help="Un segmento se re-divide si tarda más que este factor por la mediana de los segmentos terminados")
+parser.add_argument('--rezagado-segundos', type=float, default=30, help="Segundos mínimos que debe llevar un segmento antes de re-dividirlo")
+parser.add_argument('--max-bytes-imagen', type=int, default=0, help="Mueve a S3 las imágenes más grandes que este tamaño y deja en el CSV solo su ruta (0 = desactivado)")
+parser.add_argument('--workers-imagenes', type=int, default=8, help="Subidas de imágenes a S3 en paralelo")
+parser.add_argument('--plan', help="Plan JSON del planificador global (workers, segmentos y RCU por tabla)")
+parser.add_argument('--endpoint-url-dynamodb', help="Endpoint alternativo para DynamoDB y DynamoDB Streams (por ejemplo, DynamoDB Local)")
+parser.add_argument('--tenant', action='append', help="Exporta solo este tenant con Query sobre tenant_id en lugar de Scan. Se puede repetir")
 
 # Parsear los argumentos
 args = parser.parse_args()
 
-# Usamos los valores de los argumentos
-stage = args.stage
-nombre_bucket = args.bucket
+if len(args.stage) != len(args.bucket):
+    parser.error("Debe indicar un --bucket por cada --stage")
 
+# Pares (stage, bucket) que se procesan en esta ejecución
+stages = list(zip(args.stage, args.bucket))
 
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-s3 = boto3.client('s3', region_name='us-east-1')
-glue = boto3.client('glue', region_name='us-east-1')
+# Con --plan, una tabla puede llegar a recibir todo el presupuesto global de workers
+workers_maximos = args.workers_por_stage
+if args.plan and os.path.exists(args.plan):
+    with open(args.plan) as archivo_plan:
+        workers_maximos = max(workers_maximos, json.load(archivo_plan).get('workers_totales', 0))
 
-tabla_dynamo = f"{stage}-hotel-rooms"  # Tabla de habitaciones
-archivo_csv = f"{stage}-rooms.csv"    # Archivo CSV para habitaciones
-glue_database = f"{stage}-glue-database" # Base de datos de Glue
-glue_table_name = f"{stage}-rooms-table"  # Tabla de Glue
+# Límite de TotalSegments de DynamoDB, al re-dividir segmentos rezagados
+MAX_SEGMENTOS_SCAN = 1000000
 
+# Reintentos seguidos de lectura de un shard del stream antes de dar su lector por caído
+REINTENTOS_SHARD = 5
+
+# Un solo pool de conexiones compartido por todos los stages y segmentos
+config_boto = Config(max_pool_connections=max(10, args.max_stages * (workers_maximos + 1) + args.workers_imagenes))
+
+dynamodb = boto3.resource('dynamodb', region_name='us-east-1', config=config_boto, endpoint_url=args.endpoint_url_dynamodb)
+dynamodb_cliente = boto3.client('dynamodb', region_name='us-east-1', config=config_boto, endpoint_url=args.endpoint_url_dynamodb)
+dynamodbstreams = boto3.client('dynamodbstreams', region_name='us-east-1', config=config_boto, endpoint_url=args.endpoint_url_dynamodb)
+s3 = boto3.client('s3', region_name='us-east-1', config=config_boto)
+glue = boto3.client('glue', region_name='us-east-1', config=config_boto)
+
+# Bases de datos y tablas de Glue que ya se sabe que existen (caché de la ejecución, compartida entre stages):
+# las tablas que se registran más de una vez (deltas, rollups, índices) se actualizan sin volver a intentar crearlas
+catalogo_glue = set()
+lock_glue = threading.Lock()
+
+deserializador = TypeDeserializer()
+
+# Imágenes movidas a S3 por su sha256 (fuera de rooms/): pool de subidas y claves ya confirmadas en el bucket
+pool_imagenes = ThreadPoolExecutor(max_workers=args.workers_imagenes)
+imagenes_subidas = set()
+lock_imagenes = threading.Lock()
+
+# Se activa con SIGINT/SIGTERM (Ctrl+C, docker stop) para que el modo --cdc publique el último lote y termine
+parada_solicitada = threading.Event()
+
+# Tiempos por página de cada etapa del export, registrados solo con --profile
+tiempos_etapas = []
+lock_tiempos = threading.Lock()
+
+# Columnas que forman la clave primaria de cada fila (tenant_id, room_id)
+COLUMNAS_CLAVE = (0, 1)
+
+# Atributos que se leen en el scan de solo claves (los necesarios para armar las claves de las filas)
+ATRIBUTOS_CLAVE = ['tenant_id', 'room_id']
+
+# Columnas del CSV (en el orden de construir_filas) y las que llevan min/max en el manifiesto
+COLUMNAS_CSV = [
+    'tenant_id', 'room_id', 'room_name', 'max_persons', 'room_type',
+    'price_per_night', 'description', 'availability', 'created_at', 'image'
+]
+COLUMNAS_RANGO = {'created_at': str}
+COLUMNA_IMAGEN = COLUMNAS_CSV.index('image')
+
+# Esquema de la tabla de Glue (mismo orden que COLUMNAS_CSV)
+COLUMNAS_GLUE = [
+    {'Name': 'tenant_id', 'Type': 'string'},
+    {'Name': 'room_id', 'Type': 'string'},
+    {'Name': 'room_name', 'Type': 'string'},
+    {'Name': 'max_persons', 'Type': 'int'},
+    {'Name': 'room_type', 'Type': 'string'},
+    {'Name': 'price_per_night', 'Type': 'string'},
+    {'Name': 'description', 'Type': 'string'},
+    {'Name': 'availability', 'Type': 'string'},
+    {'Name': 'created_at', 'Type': 'timestamp'},
+    {'Name': 'image', 'Type': 'string'}
+]
+
+
+def nombres_stage(stage):
+    """Nombres de la tabla, el archivo CSV y los objetos de Glue de un stage."""
+    tabla_dynamo = f"{stage}-hotel-rooms"  # Tabla de habitaciones
+    archivo_csv = f"{stage}-rooms.csv"    # Archivo CSV para habitaciones
+    glue_database = f"{stage}-glue-database" # Base de datos de Glue
+    glue_table_name = f"{stage}-rooms-table"  # Tabla de Glue
+    return tabla_dynamo, archivo_csv, glue_database, glue_table_name
 
 
 def limpiar_descripcion(descripcion):
@@ -37,72 +151,1192 @@ def limpiar_descripcion(descripcion):
     return descripcion
 
 
-def exportar_dynamodb_a_csv(tabla_dynamo, archivo_csv):
+# Columna que Glue registra como timestamp y formatos de entrada que se reconocen
+COLUMNA_TIMESTAMP = 8  # created_at
+FORMATOS_TIMESTAMP = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+    '%Y-%m-%d',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y',
+]
+
+# Valores de solo dígitos: fechas compactas según su largo; epoch solo con 10 a 13 dígitos (segundos o milisegundos)
+FORMATOS_COMPACTOS = {8: ['%Y%m%d'], 14: ['%Y%m%d%H%M%S']}
+DIGITOS_EPOCH = range(10, 14)
+
+# Último formato detectado: se prueba primero en cada valor para evitar repetir la detección
+formato_timestamp = {'formato': None}
+
+
+def convertir_timestamp(valor, formato):
+    """Convierte un valor con el formato indicado ('epoch' para segundos o milisegundos)."""
+    if formato == 'epoch':
+        if len(valor.split('.')[0]) not in DIGITOS_EPOCH:
+            raise ValueError(f"{valor} no es un epoch en segundos ni en milisegundos")
+        numero = float(valor)
+        if numero > 1e11:
+            numero /= 1000  # Milisegundos
+        return datetime.fromtimestamp(numero, tz=timezone.utc).replace(tzinfo=None)
+
+    fecha = datetime.strptime(valor, formato)
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+
+def detectar_formato_timestamp(valor):
+    """Devuelve (fecha, formato) para el primer formato que reconoce el valor, o (None, None)."""
+    if valor.replace('.', '', 1).isdigit():
+        formatos = FORMATOS_COMPACTOS.get(len(valor), ['epoch'])
+    else:
+        formatos = FORMATOS_TIMESTAMP
+    for formato in formatos:
+        try:
+            return convertir_timestamp(valor, formato), formato
+        except (ValueError, OverflowError, OSError):
+            continue
+    return None, None
+
+
+def normalizar_timestamps(filas):
+    """Convierte la columna de timestamp de una página de filas al formato de Hive.
+
+    Los valores que no se pueden interpretar quedan vacíos (NULL en Athena).
+    Devuelve cuántos valores no se pudieron convertir.
+    """
+    invalidos = 0
+    for fila in filas:
+        valor = str(fila[COLUMNA_TIMESTAMP]).strip()
+        if not valor:
+            continue
+
+        fecha = None
+        formato = formato_timestamp['formato']
+        if formato is not None:
+            try:
+                fecha = convertir_timestamp(valor, formato)
+            except (ValueError, OverflowError, OSError):
+                fecha = None
+
+        if fecha is None:
+            fecha, formato = detectar_formato_timestamp(valor)
+            if fecha is None:
+                fila[COLUMNA_TIMESTAMP] = ''
+                invalidos += 1
+                continue
+            formato_timestamp['formato'] = formato
+
+        texto = fecha.strftime('%Y-%m-%d %H:%M:%S')
+        fila[COLUMNA_TIMESTAMP] = f"{texto}.{fecha.microsecond:06d}" if fecha.microsecond else texto
+
+    return invalidos
+
+
+def construir_filas(item):
+    """Convierte un item de DynamoDB en las filas del CSV (sin encabezados)."""
+    try:
+        room_id = item.get('room_id', '')
+    except ValueError:
+        room_id = ''
+
+    # Obtener el atributo 'image'
+    image = item.get('image', '')
+
+    # Limpiar la descripción para eliminar saltos de línea
+    description = limpiar_descripcion(item.get('description', ''))
+
+    row = [
+        item.get('tenant_id', ''),
+        room_id,
+        item.get('room_name', ''),
+        item.get('max_persons', ''),
+        item.get('room_type', ''),
+        item.get('price_per_night', ''),
+        description,  # Usar la descripción limpia
+        item.get('availability', ''),
+        item.get('created_at', ''),
+        image
+    ]
+
+    return [row]
+
+
+def decodificar_imagen(valor):
+    """Bytes y tipo MIME de una imagen escrita como data URL, como base64 o como texto."""
+    if valor.startswith('data:') and ',' in valor:
+        cabecera, datos = valor[5:].split(',', 1)
+        tipo = cabecera.split(';')[0] or 'application/octet-stream'
+        if cabecera.endswith(';base64'):
+            try:
+                return base64.b64decode(datos), tipo
+            except binascii.Error:
+                pass
+        else:
+            return urllib.parse.unquote_to_bytes(datos), tipo
+    try:
+        return base64.b64decode(valor, validate=True), 'application/octet-stream'
+    except binascii.Error:
+        return valor.encode('utf-8'), 'text/plain'
+
+
+def subir_imagen(nombre_bucket, clave, contenido, tipo):
+    with lock_imagenes:
+        if (nombre_bucket, clave) in imagenes_subidas:
+            return
+    try:
+        # La clave es el sha256 del contenido: si ya existe (otra habitación u otra ejecución), no se vuelve a subir
+        s3.head_object(Bucket=nombre_bucket, Key=clave)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        s3.put_object(Bucket=nombre_bucket, Key=clave, Body=contenido, ContentType=tipo)
+    with lock_imagenes:
+        imagenes_subidas.add((nombre_bucket, clave))
+
+
+def mover_imagenes_a_s3(filas, nombre_bucket):
+    """Sube a S3 las imágenes más grandes que --max-bytes-imagen y las reemplaza en la fila por la ruta del objeto.
+
+    Las subidas de una página van en paralelo y terminan antes de escribir las filas,
+    para que ninguna fila apunte a un objeto que todavía no existe.
+    """
+    if not args.max_bytes_imagen or not nombre_bucket:
+        return
+    pendientes = {}
+    for fila in filas:
+        valor = fila[COLUMNA_IMAGEN]
+        if not isinstance(valor, str) or len(valor.encode('utf-8')) <= args.max_bytes_imagen:
+            continue
+        contenido, tipo = decodificar_imagen(valor)
+        digest = hashlib.sha256(contenido).hexdigest()
+        clave = f"imagenes/sha256/{digest[:2]}/{digest}"
+        pendientes[clave] = (contenido, tipo)
+        fila[COLUMNA_IMAGEN] = f"s3://{nombre_bucket}/{clave}"
+
+    futuros = [pool_imagenes.submit(subir_imagen, nombre_bucket, clave, contenido, tipo) for clave, (contenido, tipo) in pendientes.items()]
+    for futuro in futuros:
+        futuro.result()
+
+
+def deserializar_item(item):
+    """Convierte un item en formato AttributeValue de DynamoDB a tipos de Python."""
+    return {nombre: deserializador.deserialize(valor) for nombre, valor in item.items()}
+
+
+def registrar_tiempos_pagina(tabla_dynamo, segmento, pagina, tiempos):
+    """Guarda el tiempo de cada etapa de una página (solo con --profile)."""
+    if args.profile:
+        with lock_tiempos:
+            tiempos_etapas.extend((tabla_dynamo, segmento, pagina, etapa, f"{segundos:.6f}") for etapa, segundos in tiempos)
+
+
+def muestrear_pilas(intervalo, detener, pilas):
+    """Perfilador por muestreo: cada `intervalo` segundos cuenta la pila de cada hilo."""
+    propio = threading.get_ident()
+    while not detener.wait(intervalo):
+        for hilo, frame in sys._current_frames().items():
+            if hilo == propio:
+                continue
+            pila = []
+            while frame is not None:
+                codigo = frame.f_code
+                pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                frame = frame.f_back
+            pilas[';'.join(reversed(pila))] += 1
+
+
+def escribir_perfil(directorio, pilas, duracion):
+    """Escribe las pilas colapsadas (para flamegraph.pl), las estadísticas por función y los tiempos por etapa."""
+    os.makedirs(directorio, exist_ok=True)
+
+    with open(os.path.join(directorio, 'pilas-colapsadas.txt'), 'w') as archivo:
+        for pila, muestras in pilas.most_common():
+            archivo.write(f"{pila} {muestras}\n")
+
+    propias = Counter()
+    totales = Counter()
+    for pila, muestras in pilas.items():
+        funciones = pila.split(';')
+        propias[funciones[-1]] += muestras
+        for funcion in set(funciones):
+            totales[funcion] += muestras
+
+    total = sum(pilas.values()) or 1
+    with open(os.path.join(directorio, 'funciones.txt'), 'w') as archivo:
+        archivo.write(f"{'total %':>8} {'propio %':>8} {'muestras':>9}  funcion\n")
+        for funcion, muestras in totales.most_common():
+            archivo.write(f"{100 * muestras / total:8.2f} {100 * propias[funcion] / total:8.2f} {muestras:9d}  {funcion}\n")
+
+    with open(os.path.join(directorio, 'etapas.csv'), 'w', newline='') as archivo:
+        escritor_csv = csv.writer(archivo)
+        escritor_csv.writerow(['tabla', 'segmento', 'pagina', 'etapa', 'segundos'])
+        with lock_tiempos:
+            escritor_csv.writerows(tiempos_etapas)
+
+    print(f"Perfil de {duracion:.1f} s ({total} muestras) escrito en {directorio}")
+
+
+def subir_perfil(directorio, nombre_bucket):
+    """Sube los archivos del perfil a perfiles/rooms/<fecha>/, porque el contenedor no los conserva."""
+    prefijo = f"perfiles/rooms/{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}/"
+    for nombre in os.listdir(directorio):
+        s3.upload_file(os.path.join(directorio, nombre), nombre_bucket, f"{prefijo}{nombre}")
+    print(f"Perfil subido a s3://{nombre_bucket}/{prefijo}")
+
+
+def nuevas_estadisticas():
+    return {'filas': 0, 'tenants': set(), 'nulos': Counter(), 'minimos': {}, 'maximos': {}}
+
+
+def acumular_estadisticas(estadisticas, filas):
+    """Actualiza las estadísticas de un archivo con las filas que se le escriben."""
+    minimos = estadisticas['minimos']
+    maximos = estadisticas['maximos']
+    for fila in filas:
+        estadisticas['filas'] += 1
+        estadisticas['tenants'].add(fila[0])
+        for columna, valor in zip(COLUMNAS_CSV, fila):
+            if valor == '' or valor is None:
+                estadisticas['nulos'][columna] += 1
+            elif columna in COLUMNAS_RANGO:
+                try:
+                    valor = COLUMNAS_RANGO[columna](valor)
+                except (ValueError, ArithmeticError):
+                    continue
+                if columna not in minimos or valor < minimos[columna]:
+                    minimos[columna] = valor
+                if columna not in maximos or valor > maximos[columna]:
+                    maximos[columna] = valor
+
+
+def escribir_manifiesto(nombre_bucket, clave_datos, estadisticas):
+    """Publica las estadísticas junto al archivo de datos y devuelve la ruta del manifiesto.
+
+    El nombre empieza con '_' para que Athena no lo lea como parte de la tabla.
+    """
+    carpeta, nombre = clave_datos.rsplit('/', 1)
+    clave = f"{carpeta}/_{nombre}.manifiesto.json"
+    manifiesto = {
+        'archivo': f"s3://{nombre_bucket}/{clave_datos}",
+        'filas': estadisticas['filas'],
+        'tenants': sorted(estadisticas['tenants']),
+        'columnas': {columna: {'nulos': estadisticas['nulos'][columna]} for columna in COLUMNAS_CSV},
+    }
+    for columna, minimo in estadisticas['minimos'].items():
+        manifiesto['columnas'][columna]['min'] = str(minimo)
+        manifiesto['columnas'][columna]['max'] = str(estadisticas['maximos'][columna])
+
+    s3.put_object(Bucket=nombre_bucket, Key=clave, Body=json.dumps(manifiesto, ensure_ascii=False).encode('utf-8'))
+    return f"s3://{nombre_bucket}/{clave}"
+
+
+def parametros_estadisticas(estadisticas, manifiesto):
+    """Parámetros de la tabla de Glue con las estadísticas del archivo publicado."""
+    parametros = {
+        'recordCount': str(estadisticas['filas']),
+        'numTenants': str(len(estadisticas['tenants'])),
+        'manifiesto': manifiesto,
+    }
+    for columna, minimo in estadisticas['minimos'].items():
+        parametros[f"min_{columna}"] = str(minimo)
+        parametros[f"max_{columna}"] = str(estadisticas['maximos'][columna])
+    return parametros
+
+
+def leer_asignacion(tabla_dynamo):
+    """Workers, segmentos y RCU que el plan del planificador asigna a la tabla ({} sin --plan)."""
+    if not args.plan:
+        return {}
+    try:
+        with open(args.plan) as archivo:
+            return json.load(archivo)['tablas'].get(tabla_dynamo, {})
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def marcar_tabla_terminada(tabla_dynamo):
+    """Avisa al planificador que la tabla terminó, para que reasigne sus workers."""
+    if args.plan:
+        open(os.path.join(os.path.dirname(args.plan), f"terminado-{tabla_dynamo}"), 'w').close()
+
+
+def nuevo_limitador():
+    return {'disponible': 0.0, 'instante': time.monotonic(), 'lock': threading.Lock()}
+
+
+def esperar_capacidad(limitador, rcu_por_segundo, unidades):
+    """Descuenta las RCU que consumió una página y duerme si la tabla superó su presupuesto."""
+    if not rcu_por_segundo:
+        return
+    with limitador['lock']:
+        ahora = time.monotonic()
+        limitador['disponible'] = min(rcu_por_segundo, limitador['disponible'] + (ahora - limitador['instante']) * rcu_por_segundo)
+        limitador['instante'] = ahora
+        limitador['disponible'] -= unidades
+        espera = -limitador['disponible'] / rcu_por_segundo if limitador['disponible'] < 0 else 0
+    if espera:
+        time.sleep(espera)
+
+
+def clave_item(item):
+    """Huella de 64 bits de la clave primaria del item."""
+    return hash_clave(tuple(str(item.get(atributo)) for atributo in ATRIBUTOS_CLAVE[:2]))
+
+
+def contiene_huella(huellas, huella):
+    """Búsqueda binaria en un array('Q') ordenado."""
+    i = bisect.bisect_left(huellas, huella)
+    return i < len(huellas) and huellas[i] == huella
+
+
+def nueva_tarea_scan(segmento, total, excluir=None):
+    """Segmento de scan pendiente. `excluir` son las huellas (ordenadas) que ya exportó el segmento rezagado del que salió."""
+    return {
+        'segmento': segmento, 'total': total, 'excluir': excluir if excluir is not None else array('Q'),
+        'emitidas': array('Q'), 'items': 0, 'inicio': None, 'cancelado': False,
+    }
+
+
+def dividir_tarea_scan(tarea, partes):
+    """Re-divide un segmento rezagado en `partes` segmentos más finos.
+
+    El segmento s de N cubre el mismo rango de hash que los segmentos s*k .. s*k+k-1 de k*N,
+    así que los nuevos segmentos recorren la misma parte de la tabla que el original. Las claves
+    que el original ya exportó se excluyen para no duplicar filas.
+    """
+    tarea['cancelado'] = True
+    # Las huellas emitidas ya se filtraron contra `excluir`, así que la mezcla no repite valores
+    excluir = array('Q', heapq.merge(tarea['excluir'], sorted(tarea['emitidas'])))
+    total = tarea['total'] * partes
+    return [nueva_tarea_scan(tarea['segmento'] * partes + parte, total, excluir) for parte in range(partes)]
+
+
+def buscar_rezagado(tareas_activas, duraciones):
+    """Segmento en curso con menor ritmo entre los que ya tardan más de lo normal (None si no hay)."""
+    if not duraciones:
+        return None
+    mediana = sorted(duraciones)[len(duraciones) // 2]
+    limite = max(args.rezagado_segundos, args.rezagado_factor * mediana)
+    ahora = time.monotonic()
+    candidatos = [
+        tarea for tarea in tareas_activas
+        if not tarea['cancelado'] and tarea['total'] * 2 <= MAX_SEGMENTOS_SCAN and ahora - tarea['inicio'] >= limite
+    ]
+    return min(candidatos, key=lambda tarea: tarea['items'] / (ahora - tarea['inicio']), default=None)
+
+
+def exportar_dynamodb_a_csv(tabla_dynamo, archivo_csv, workers=1, claves=None, nombre_bucket=None):
     print(f"Exportando datos desde DynamoDB ({tabla_dynamo})...")
+    lock_escritura = threading.Lock()
+    estadisticas = nuevas_estadisticas()
+
+    # Con --plan, el planificador define los segmentos, los workers y las RCU de la tabla
+    asignacion = {'workers': workers, 'segmentos': workers, 'rcu': 0}
+    asignacion.update(leer_asignacion(tabla_dynamo))
+    if asignacion['workers'] == 0:
+        # Hay más tablas que workers o RCU: la tabla queda en cola hasta que el planificador le pase los de otra
+        print(f"{tabla_dynamo} en cola: se espera a que el planificador le asigne workers...")
+        while asignacion['workers'] == 0:
+            time.sleep(2)
+            asignacion.update(leer_asignacion(tabla_dynamo))
+    total_segmentos = max(1, asignacion['segmentos'])
+    segmentos_pendientes = queue.Queue()
+    for segmento in range(total_segmentos):
+        segmentos_pendientes.put(nueva_tarea_scan(segmento, total_segmentos))
+    tareas_activas = []
+    duraciones = []
+    limitador = nuevo_limitador()
+    timestamps_invalidos = [0]
+
+    with open(archivo_csv, 'w', newline='') as archivo:
+        escritor_csv = csv.writer(archivo)
+
+        def escanear_segmento(tarea):
+            scan_kwargs = {'TableName': tabla_dynamo, 'ReturnConsumedCapacity': 'TOTAL'}
+            pagina = 0
+            segmento = f"{tarea['segmento']}/{tarea['total']}"
+            if tarea['total'] > 1:
+                # Scan paralelo: cada segmento recorre una parte distinta de la tabla
+                scan_kwargs['Segment'] = tarea['segmento']
+                scan_kwargs['TotalSegments'] = tarea['total']
+
+            while True:
+                inicio = time.perf_counter()
+                respuesta = dynamodb_cliente.scan(**scan_kwargs)
+                fin_scan = time.perf_counter()
+                # Se deserializa aparte (cliente de bajo nivel) para medir cada etapa por separado
+                items = [deserializar_item(item) for item in respuesta['Items']]
+                if tarea['excluir']:
+                    items = [item for item in items if not contiene_huella(tarea['excluir'], clave_item(item))]
+                fin_deserializacion = time.perf_counter()
+                filas = [fila for item in items for fila in construir_filas(item)]
+                invalidos = normalizar_timestamps(filas)
+                mover_imagenes_a_s3(filas, nombre_bucket)
+                fin_limpieza = time.perf_counter()
+
+                with lock_escritura:
+                    if tarea['cancelado']:
+                        # El segmento se re-dividió mientras se leía esta página: la recorren los nuevos segmentos
+                        break
+                    inicio_escritura = time.perf_counter()
+                    escritor_csv.writerows(filas)
+                    if args.redividir_rezagados:
+                        tarea['emitidas'].extend(clave_item(item) for item in items)
+                    tarea['items'] += len(items)
+                    acumular_estadisticas(estadisticas, filas)
+                    if claves is not None:
+                        registrar_claves(claves, filas)
+                    timestamps_invalidos[0] += invalidos
+                    fin_escritura = time.perf_counter()
+
+                registrar_tiempos_pagina(tabla_dynamo, segmento, pagina, (
+                    ('scan', fin_scan - inicio),
+                    ('deserializacion', fin_deserializacion - fin_scan),
+                    ('limpieza', fin_limpieza - fin_deserializacion),
+                    ('escritura', fin_escritura - inicio_escritura),
+                ))
+                pagina += 1
+                esperar_capacidad(limitador, asignacion['rcu'], respuesta.get('ConsumedCapacity', {}).get('CapacityUnits', 0))
+
+                if 'LastEvaluatedKey' in respuesta and not tarea['cancelado']:
+                    scan_kwargs['ExclusiveStartKey'] = respuesta['LastEvaluatedKey']
+                else:
+                    break
+
+        def trabajador():
+            # Cada worker toma segmentos pendientes hasta que no quede ninguno
+            while True:
+                try:
+                    tarea = segmentos_pendientes.get_nowait()
+                except queue.Empty:
+                    return
+                tarea['inicio'] = time.monotonic()
+                with lock_escritura:
+                    tareas_activas.append(tarea)
+                try:
+                    escanear_segmento(tarea)
+                finally:
+                    with lock_escritura:
+                        tareas_activas.remove(tarea)
+                        if not tarea['cancelado']:
+                            duraciones.append(time.monotonic() - tarea['inicio'])
+                        tarea['emitidas'] = array('Q')
+
+        with ThreadPoolExecutor(max_workers=max(total_segmentos, workers_maximos)) as executor:
+            futuros = [executor.submit(trabajador) for _ in range(min(max(1, asignacion['workers']), total_segmentos))]
+
+            while not all(futuro.done() for futuro in futuros):
+                wait(futuros, timeout=1)
+                # Cuando otra tabla termina, el planificador le asigna más workers a esta: se suman en caliente
+                if args.plan:
+                    asignacion.update(leer_asignacion(tabla_dynamo))
+                libres = asignacion['workers'] - sum(not futuro.done() for futuro in futuros)
+
+                # Sin segmentos pendientes y con workers libres, el segmento rezagado se re-divide entre ellos
+                if args.redividir_rezagados and libres > 0 and segmentos_pendientes.empty():
+                    with lock_escritura:
+                        rezagado = buscar_rezagado(tareas_activas, duraciones)
+                        if rezagado:
+                            partes = min(libres + 1, MAX_SEGMENTOS_SCAN // rezagado['total'])
+                            for nueva in dividir_tarea_scan(rezagado, partes):
+                                segmentos_pendientes.put(nueva)
+                    if rezagado:
+                        print(f"Segmento {rezagado['segmento']}/{rezagado['total']} de {tabla_dynamo} rezagado: se re-divide en {partes} segmentos")
+
+                for _ in range(min(libres, segmentos_pendientes.qsize())):
+                    futuros.append(executor.submit(trabajador))
+
+            for futuro in futuros:
+                futuro.result()
+
+    if timestamps_invalidos[0]:
+        print(f"{timestamps_invalidos[0]} valores de created_at no se pudieron convertir a timestamp.")
+    print(f"Datos exportados a {archivo_csv} ({estadisticas['filas']} filas)")
+    return estadisticas
+
+
+def exportar_tenant_a_csv(tabla_dynamo, tenant_id, archivo_csv, nombre_bucket=None):
+    """Exporta solo los items de un tenant usando Query sobre la clave de partición."""
+    print(f"Exportando datos del tenant {tenant_id} desde DynamoDB ({tabla_dynamo})...")
     tabla = dynamodb.Table(tabla_dynamo)
-    scan_kwargs = {}
+    query_kwargs = {'KeyConditionExpression': Key('tenant_id').eq(tenant_id)}
+    timestamps_invalidos = 0
 
     with open(archivo_csv, 'w', newline='') as archivo:
         escritor_csv = csv.writer(archivo)
 
         while True:
-            respuesta = tabla.scan(**scan_kwargs)
-            items = respuesta['Items']
+            respuesta = tabla.query(**query_kwargs)
+            filas = [fila for item in respuesta['Items'] for fila in construir_filas(item)]
+            timestamps_invalidos += normalizar_timestamps(filas)
+            mover_imagenes_a_s3(filas, nombre_bucket)
+            escritor_csv.writerows(filas)
 
-            if not items:
+            if 'LastEvaluatedKey' in respuesta:
+                query_kwargs['ExclusiveStartKey'] = respuesta['LastEvaluatedKey']
+            else:
                 break
 
-            for item in items:
-                try:
-                    room_id = item.get('room_id', '')
-                except ValueError:
-                    room_id = ''
-
-                # Obtener el atributo 'image'
-                image = item.get('image', '')
-
-                # Limpiar la descripción para eliminar saltos de línea
-                description = limpiar_descripcion(item.get('description', ''))
-
-                row = [
-                    item.get('tenant_id', ''),
-                    room_id,
-                    item.get('room_name', ''),
-                    item.get('max_persons', ''),
-                    item.get('room_type', ''),
-                    item.get('price_per_night', ''),
-                    description,  # Usar la descripción limpia
-                    item.get('availability', ''),
-                    item.get('created_at', ''),
-                    image
+    if timestamps_invalidos:
+        print(f"{timestamps_invalidos} valores de created_at del tenant {tenant_id} no se pudieron convertir a timestamp.")
+    print(f"Datos del tenant {tenant_id} exportados a {archivo_csv}")
+
+
+def exportar_tenants(stage, nombre_bucket, tenants, workers=1):
+    """Exporta varios tenants en paralelo, cada uno bajo su propio prefijo tenants/<tenant_id>/rooms/."""
+    tabla_dynamo, archivo_csv, _, _ = nombres_stage(stage)
+
+    def exportar_y_subir(tenant_id):
+        archivo_tenant = f"{tenant_id}-{archivo_csv}"
+        exportar_tenant_a_csv(tabla_dynamo, tenant_id, archivo_tenant, nombre_bucket)
+        return subir_csv_a_s3(archivo_tenant, nombre_bucket, f"tenants/{tenant_id}/rooms/")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        resultados = list(executor.map(exportar_y_subir, tenants))
+
+    if not all(resultados):
+        print("No se pudieron subir a S3 todos los archivos de los tenants.")
+
+
+def cargar_checkpoints(nombre_bucket, clave):
+    """Lee de S3 la última secuencia procesada de cada shard (vacío si no hay checkpoint)."""
+    try:
+        respuesta = s3.get_object(Bucket=nombre_bucket, Key=clave)
+        return json.loads(respuesta['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+
+def guardar_checkpoints(nombre_bucket, clave, checkpoints):
+    s3.put_object(Bucket=nombre_bucket, Key=clave, Body=json.dumps(checkpoints).encode('utf-8'))
+
+
+def listar_shards(stream_arn):
+    """Devuelve todos los shards del stream, paginando describe_stream."""
+    shards = []
+    describe_kwargs = {'StreamArn': stream_arn}
+
+    while True:
+        descripcion = dynamodbstreams.describe_stream(**describe_kwargs)['StreamDescription']
+        shards.extend(descripcion['Shards'])
+
+        if 'LastEvaluatedShardId' in descripcion:
+            describe_kwargs['ExclusiveStartShardId'] = descripcion['LastEvaluatedShardId']
+        else:
+            return shards
+
+
+def registro_a_filas(registro):
+    """Convierte un registro INSERT/MODIFY/REMOVE del stream en filas con el layout del CSV.
+
+    Al final de cada fila se agregan la operación y una versión ordenable
+    (milisegundos de creación + número de secuencia), que Athena ignora por
+    ser columnas extra y que usa la compactación para quedarse con la última.
+    """
+    datos = registro['dynamodb']
+    operacion = registro['eventName']
+    imagen = datos.get('OldImage') if operacion == 'REMOVE' else datos.get('NewImage')
+    item = deserializar_item(imagen or datos['Keys'])
+
+    creado = datos.get('ApproximateCreationDateTime', 0)
+    milisegundos = int((creado.timestamp() if hasattr(creado, 'timestamp') else float(creado)) * 1000)
+    version = f"{milisegundos:015d}-{int(datos['SequenceNumber']):040d}"
+
+    return [fila + [operacion, version] for fila in construir_filas(item)]
+
+
+def publicar_delta(nombre_bucket, stage, filas):
+    """Sube un archivo de deltas (filas con operación y versión al final) junto con su manifiesto."""
+    archivo_s3 = f"deltas/rooms/{stage}/{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.csv"
+    mover_imagenes_a_s3(filas, nombre_bucket)
+    texto = io.StringIO()
+    csv.writer(texto).writerows(filas)
+    s3.put_object(Bucket=nombre_bucket, Key=archivo_s3, Body=texto.getvalue().encode('utf-8'))
+    registrar_deltas_en_glue(stage, nombre_bucket)
+
+    estadisticas = nuevas_estadisticas()
+    acumular_estadisticas(estadisticas, filas)
+    escribir_manifiesto(nombre_bucket, archivo_s3, estadisticas)
+    return archivo_s3
+
+
+def consumir_stream(stage, nombre_bucket, intervalo=60, max_filas=10000, duracion=None):
+    """Lee los shards del DynamoDB Stream en paralelo y publica micro-lotes en S3.
+
+    Los lotes se escriben en deltas/rooms/<stage>/ cuando pasan `intervalo`
+    segundos o se acumulan `max_filas` filas. Después de cada lote se guarda
+    el checkpoint de cada shard, así que una nueva ejecución continúa donde
+    quedó la anterior (entrega al menos una vez).
+    """
+    tabla_dynamo, _, _, _ = nombres_stage(stage)
+    stream_arn = dynamodb.Table(tabla_dynamo).latest_stream_arn
+    if not stream_arn:
+        print(f"La tabla {tabla_dynamo} no tiene un DynamoDB Stream habilitado.")
+        return
+
+    print(f"Consumiendo el stream de {tabla_dynamo} ({stream_arn})...")
+    clave_checkpoints = f"cdc-checkpoints/rooms/{stage}.json"
+    checkpoints = cargar_checkpoints(nombre_bucket, clave_checkpoints)
+
+    buffer = []
+    pendientes = {}  # shard -> última secuencia incluida en el buffer
+    lock_buffer = threading.Lock()
+    detener = threading.Event()
+    terminados = {}  # shard -> evento que se activa cuando el shard se leyó completo
+    hilos = {}
+    caidas = {}  # shard -> veces que su lector se detuvo por errores
+    timestamps_invalidos = [0]
+
+    def leer_shard(shard):
+        shard_id = shard['ShardId']
+
+        # Los registros del shard hijo solo se leen cuando el padre terminó, para respetar el orden por clave
+        padre = terminados.get(shard.get('ParentShardId'))
+        while padre is not None and not padre.wait(1):
+            if detener.is_set():
+                return
+
+        def obtener_iterador():
+            iterador_kwargs = {'StreamArn': stream_arn, 'ShardId': shard_id, 'ShardIteratorType': 'TRIM_HORIZON'}
+            if ultima:
+                iterador_kwargs['ShardIteratorType'] = 'AFTER_SEQUENCE_NUMBER'
+                iterador_kwargs['SequenceNumber'] = ultima
+
+            try:
+                return dynamodbstreams.get_shard_iterator(**iterador_kwargs)['ShardIterator']
+            except dynamodbstreams.exceptions.TrimmedDataAccessException:
+                print(f"El checkpoint del shard {shard_id} ya expiró; se lee desde el inicio disponible.")
+                iterador_kwargs['ShardIteratorType'] = 'TRIM_HORIZON'
+                iterador_kwargs.pop('SequenceNumber')
+                return dynamodbstreams.get_shard_iterator(**iterador_kwargs)['ShardIterator']
+
+        # Se continúa desde lo último que el shard dejó en el buffer o, si no hay nada, desde su checkpoint
+        with lock_buffer:
+            ultima = pendientes.get(shard_id) or checkpoints.get(shard_id)
+        iterador = None
+        intentos = 0
+
+        while not detener.is_set():
+            try:
+                if iterador is None:
+                    iterador = obtener_iterador()
+                respuesta = dynamodbstreams.get_records(ShardIterator=iterador, Limit=1000)
+            except Exception as e:
+                # Throttling, iterador vencido o error de red: se pide un iterador nuevo desde la última secuencia leída
+                intentos += 1
+                if intentos > REINTENTOS_SHARD:
+                    raise
+                espera = min(60, 2 ** intentos)
+                print(f"Error leyendo el shard {shard_id} (intento {intentos} de {REINTENTOS_SHARD}): {e}. Se reintenta en {espera} s.")
+                iterador = None
+                detener.wait(espera)
+                continue
+            intentos = 0
+            registros = respuesta['Records']
+
+            if registros:
+                filas = [fila for registro in registros for fila in registro_a_filas(registro)]
+                invalidos = normalizar_timestamps(filas)
+                with lock_buffer:
+                    buffer.extend(filas)
+                    timestamps_invalidos[0] += invalidos
+                    ultima = registros[-1]['dynamodb']['SequenceNumber']
+                    pendientes[shard_id] = ultima
+            else:
+                detener.wait(1)
+
+            iterador = respuesta.get('NextShardIterator')
+            if not iterador:
+                # Shard cerrado y leído completo
+                terminados[shard_id].set()
+                return
+
+    def leer_shard_seguro(shard):
+        try:
+            leer_shard(shard)
+        except Exception as e:
+            # El hilo termina; el bucle principal lo vuelve a lanzar en el próximo listado de shards
+            with lock_buffer:
+                caidas[shard['ShardId']] = caidas.get(shard['ShardId'], 0) + 1
+            print(f"ERROR: el lector del shard {shard['ShardId']} se detuvo después de {REINTENTOS_SHARD} reintentos: {e}")
+
+    def publicar_lote():
+        with lock_buffer:
+            filas = buffer[:]
+            buffer.clear()
+            secuencias = dict(pendientes)
+            pendientes.clear()
+
+        if filas:
+            archivo_s3 = publicar_delta(nombre_bucket, stage, filas)
+            print(f"Micro-lote de {len(filas)} filas publicado en s3://{nombre_bucket}/{archivo_s3}")
+
+        if secuencias:
+            checkpoints.update(secuencias)
+            guardar_checkpoints(nombre_bucket, clave_checkpoints, checkpoints)
+
+    inicio = time.monotonic()
+    ultimo_lote = inicio
+    ultimo_listado = None
+
+    try:
+        while not detener.is_set():
+            ahora = time.monotonic()
+
+            # Se vuelven a listar los shards periódicamente para tomar los nuevos y relanzar los lectores caídos
+            if ultimo_listado is None or ahora - ultimo_listado >= intervalo:
+                shards = [
+                    shard for shard in listar_shards(stream_arn)
+                    if shard['ShardId'] not in hilos
+                    or not (hilos[shard['ShardId']].is_alive() or terminados[shard['ShardId']].is_set())
                 ]
+                for shard in shards:
+                    # Si el lector se relanza, los shards hijos siguen esperando el mismo evento
+                    terminados.setdefault(shard['ShardId'], threading.Event())
+                for shard in shards:
+                    if shard['ShardId'] in hilos:
+                        print(f"Relanzando el lector del shard {shard['ShardId']} (caído {caidas.get(shard['ShardId'], 0)} veces)...")
+                    hilos[shard['ShardId']] = threading.Thread(target=leer_shard_seguro, args=(shard,), daemon=True)
+                    hilos[shard['ShardId']].start()
+                ultimo_listado = ahora
 
-                escritor_csv.writerow(row)
+            with lock_buffer:
+                filas_en_buffer = len(buffer)
 
-            if 'LastEvaluatedKey' in respuesta:
-                scan_kwargs['ExclusiveStartKey'] = respuesta['LastEvaluatedKey']
+            if filas_en_buffer >= max_filas or ahora - ultimo_lote >= intervalo:
+                publicar_lote()
+                ultimo_lote = ahora
+
+            if parada_solicitada.is_set():
+                print("Deteniendo el consumo del stream...")
+                detener.set()
+            elif duracion is not None and ahora - inicio >= duracion:
+                detener.set()
             else:
-                break
+                parada_solicitada.wait(0.5)
+    finally:
+        for hilo in hilos.values():
+            hilo.join(timeout=5)
+        publicar_lote()
 
-    print(f"Datos exportados a {archivo_csv}")
+    if caidas:
+        print(f"ADVERTENCIA: lectores de shards que se cayeron durante el consumo: {caidas}")
+    if timestamps_invalidos[0]:
+        print(f"{timestamps_invalidos[0]} valores de created_at del stream no se pudieron convertir a timestamp.")
+    print(f"Consumo del stream de {tabla_dynamo} finalizado.")
 
 
-def subir_csv_a_s3(archivo_csv, nombre_bucket):
-    carpeta_destino = 'rooms/'
+def subir_csv_a_s3(archivo_csv, nombre_bucket, carpeta_destino):
     archivo_s3 = f"{carpeta_destino}{archivo_csv}"
-    print(f"Subiendo {archivo_csv} al bucket S3 ({nombre_bucket}) en la carpeta 'rooms'...")
+    print(f"Subiendo {archivo_csv} al bucket S3 ({nombre_bucket}) en la carpeta '{carpeta_destino}'...")
 
     try:
         s3.upload_file(archivo_csv, nombre_bucket, archivo_s3)
-        print(f"Archivo subido exitosamente a S3 en la carpeta 'rooms'.")
+        print(f"Archivo subido exitosamente a S3 en la carpeta '{carpeta_destino}'.")
         return True
     except Exception as e:
         print(f"Error al subir el archivo a S3: {e}")
         return False
 
 
+def listar_objetos_s3(nombre_bucket, prefijo):
+    """Lista todos los objetos bajo un prefijo, en orden lexicográfico de clave."""
+    objetos = []
+    paginador = s3.get_paginator('list_objects_v2')
+    for pagina in paginador.paginate(Bucket=nombre_bucket, Prefix=prefijo):
+        objetos.extend(pagina.get('Contents', []))
+    return objetos
+
+
+def es_archivo_de_datos(clave):
+    """Athena ignora los archivos que empiezan con '_' o '.' (por ejemplo, los manifiestos)."""
+    return not clave.rsplit('/', 1)[-1].startswith(('_', '.'))
+
+
+def borrar_objetos_s3(nombre_bucket, claves):
+    """Borra objetos de S3 en lotes de 1000 (límite de delete_objects)."""
+    for i in range(0, len(claves), 1000):
+        s3.delete_objects(
+            Bucket=nombre_bucket,
+            Delete={'Objects': [{'Key': clave} for clave in claves[i:i + 1000]], 'Quiet': True}
+        )
+
+
+def leer_filas_s3(nombre_bucket, clave):
+    """Lee un CSV de S3 fila por fila sin cargarlo completo en memoria."""
+    cuerpo = s3.get_object(Bucket=nombre_bucket, Key=clave)['Body']
+    yield from csv.reader(codecs.getreader('utf-8')(cuerpo))
+
+
+def actualizar_ubicacion_glue(glue_database, glue_table_name, ubicacion, parametros=None):
+    """Apunta la tabla de Glue a otra ubicación de S3 con una sola llamada a update_table."""
+    tabla = glue.get_table(DatabaseName=glue_database, Name=glue_table_name)['Table']
+    campos = ('Name', 'Description', 'Owner', 'Retention', 'StorageDescriptor', 'PartitionKeys', 'TableType', 'Parameters')
+    table_input = {campo: tabla[campo] for campo in campos if campo in tabla}
+    table_input['StorageDescriptor']['Location'] = ubicacion
+    table_input.setdefault('Parameters', {}).update(parametros or {})
+    glue.update_table(DatabaseName=glue_database, TableInput=table_input)
+
+
+def purgar_deltas_anteriores(nombre_bucket, stage, instante):
+    """Borra los deltas publicados antes de `instante`: ya están incluidos en el export completo."""
+    deltas = listar_objetos_s3(nombre_bucket, f"deltas/rooms/{stage}/")
+    claves = [objeto['Key'] for objeto in deltas if objeto['LastModified'].timestamp() < instante]
+    if claves:
+        borrar_objetos_s3(nombre_bucket, claves)
+        print(f"Se eliminaron {len(claves)} objetos de deltas incluidos en el export completo.")
+
+
+def nuevo_prefijo_version(stage):
+    """Prefijo de S3 para una nueva versión publicada (export completo o compactación).
+
+    El nombre empieza con la fecha en milisegundos para que las versiones se ordenen
+    cronológicamente; el sufijo aleatorio evita choques entre ejecuciones simultáneas.
+    """
+    ahora = time.time()
+    marca = time.strftime('%Y%m%dT%H%M%S', time.gmtime(ahora))
+    return f"snapshots/rooms/{stage}/{marca}{int(ahora * 1000) % 1000:03d}Z-{uuid.uuid4().hex[:6]}/"
+
+
+def listar_versiones(nombre_bucket, stage):
+    """Prefijos de las versiones publicadas de un stage, de la más antigua a la más reciente."""
+    versiones = []
+    paginador = s3.get_paginator('list_objects_v2')
+    for pagina in paginador.paginate(Bucket=nombre_bucket, Prefix=f"snapshots/rooms/{stage}/", Delimiter='/'):
+        versiones.extend(prefijo['Prefix'] for prefijo in pagina.get('CommonPrefixes', []))
+    return sorted(versiones)
+
+
+def podar_versiones(nombre_bucket, stage, version_actual, versiones_retenidas):
+    """Borra las versiones anteriores a la actual salvo las `versiones_retenidas` más recientes.
+
+    Las versiones posteriores a la actual (por ejemplo, de una ejecución en curso) no se tocan.
+    """
+    anteriores = [version for version in listar_versiones(nombre_bucket, stage) if version < version_actual]
+    obsoletas = anteriores[:max(0, len(anteriores) - versiones_retenidas)]
+    for version in obsoletas:
+        borrar_objetos_s3(nombre_bucket, [objeto['Key'] for objeto in listar_objetos_s3(nombre_bucket, version)])
+    if obsoletas:
+        print(f"Se eliminaron {len(obsoletas)} versiones antiguas de snapshots/rooms/{stage}/.")
+
+
+def parametros_desde_manifiesto(nombre_bucket, clave):
+    """Reconstruye los parámetros de Glue de una versión a partir de su manifiesto."""
+    try:
+        manifiesto = json.loads(s3.get_object(Bucket=nombre_bucket, Key=clave)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+    parametros = {
+        'recordCount': str(manifiesto['filas']),
+        'numTenants': str(len(manifiesto['tenants'])),
+        'manifiesto': f"s3://{nombre_bucket}/{clave}",
+    }
+    for columna, valores in manifiesto['columnas'].items():
+        if 'min' in valores:
+            parametros[f"min_{columna}"] = valores['min']
+            parametros[f"max_{columna}"] = valores['max']
+    return parametros
+
+
+def revertir_version(stage, nombre_bucket):
+    """Vuelve a apuntar la tabla de Glue a la versión anterior a la publicada."""
+    _, archivo_csv, glue_database, glue_table_name = nombres_stage(stage)
+    try:
+        ubicacion = glue.get_table(DatabaseName=glue_database, Name=glue_table_name)['Table']['StorageDescriptor']['Location']
+    except glue.exceptions.EntityNotFoundException:
+        print(f"La tabla {glue_table_name} no existe.")
+        return False
+
+    version_actual = ubicacion.replace(f"s3://{nombre_bucket}/", '', 1)
+    anteriores = [version for version in listar_versiones(nombre_bucket, stage) if version < version_actual]
+    if not anteriores:
+        print(f"No hay una versión anterior a {ubicacion} para revertir.")
+        return False
+
+    destino = anteriores[-1]
+    parametros = parametros_desde_manifiesto(nombre_bucket, f"{destino}_{archivo_csv}.manifiesto.json")
+    actualizar_ubicacion_glue(glue_database, glue_table_name, f"s3://{nombre_bucket}/{destino}", parametros)
+    print(f"Tabla {glue_table_name} revertida a s3://{nombre_bucket}/{destino}")
+    return True
+
+
+def compactar_deltas(stage, nombre_bucket, memoria_mb=256):
+    """Fusiona el snapshot actual y los deltas en un nuevo snapshot base.
+
+    Las filas se reparten por hash de la clave primaria en archivos locales,
+    de modo que cada partición quepa en `memoria_mb`. En cada partición gana
+    la versión más reciente de cada clave y los REMOVE se descartan. Después
+    se apunta la tabla de Glue al nuevo snapshot y se borran los deltas fusionados.
+    """
+    _, archivo_csv, glue_database, glue_table_name = nombres_stage(stage)
+    objetos_deltas = listar_objetos_s3(nombre_bucket, f"deltas/rooms/{stage}/")
+    deltas = [objeto for objeto in objetos_deltas if es_archivo_de_datos(objeto['Key'])]
+    if not deltas:
+        print(f"No hay deltas para compactar en deltas/rooms/{stage}/.")
+        return False
+
+    try:
+        ubicacion = glue.get_table(DatabaseName=glue_database, Name=glue_table_name)['Table']['StorageDescriptor']['Location']
+    except glue.exceptions.EntityNotFoundException:
+        print(f"La tabla {glue_table_name} no existe. Ejecute primero la exportación completa.")
+        return False
+
+    # El snapshot base es el CSV del export completo o el contenido del último snapshot compactado
+    prefijo_base = ubicacion.replace(f"s3://{nombre_bucket}/", '', 1)
+    if prefijo_base == 'rooms/':
+        base = [objeto for objeto in listar_objetos_s3(nombre_bucket, f"rooms/{archivo_csv}") if objeto['Key'] == f"rooms/{archivo_csv}"]
+    else:
+        base = [objeto for objeto in listar_objetos_s3(nombre_bucket, prefijo_base) if es_archivo_de_datos(objeto['Key'])]
+
+    # Particiones suficientes para que cada una quepa en memoria (factor 3 por el overhead de los objetos de Python)
+    total_bytes = sum(objeto['Size'] for objeto in base + deltas)
+    particiones = min(256, max(1, -(-total_bytes * 3 // (memoria_mb * 1024 * 1024))))
+    print(f"Compactando {len(base)} objetos base y {len(deltas)} deltas en {particiones} particiones...")
+
+    with tempfile.TemporaryDirectory() as directorio:
+        rutas = [os.path.join(directorio, f"particion-{i:03d}.csv") for i in range(particiones)]
+        archivos = [open(ruta, 'w', newline='') for ruta in rutas]
+        escritores = [csv.writer(archivo) for archivo in archivos]
+
+        def repartir(fila, operacion, version):
+            clave = '\x1f'.join(fila[i] for i in COLUMNAS_CLAVE)
+            escritores[zlib.crc32(clave.encode('utf-8')) % particiones].writerow([version, operacion] + fila)
+
+        try:
+            for objeto in base:
+                for fila in leer_filas_s3(nombre_bucket, objeto['Key']):
+                    repartir(fila, 'INSERT', '')  # Las filas base pierden contra cualquier delta
+            for objeto in deltas:
+                for fila in leer_filas_s3(nombre_bucket, objeto['Key']):
+                    repartir(fila[:-2], fila[-2], fila[-1])
+        finally:
+            for archivo in archivos:
+                archivo.close()
+
+        archivo_snapshot = os.path.join(directorio, archivo_csv)
+        estadisticas = nuevas_estadisticas()
+        with open(archivo_snapshot, 'w', newline='') as salida:
+            escritor_csv = csv.writer(salida)
+            for ruta in rutas:
+                ultimas = {}
+                with open(ruta, newline='') as entrada:
+                    for version, operacion, *fila in csv.reader(entrada):
+                        clave = tuple(fila[i] for i in COLUMNAS_CLAVE)
+                        actual = ultimas.get(clave)
+                        # Los deltas se leen en orden, así que ante la misma versión gana el último
+                        if actual is None or version >= actual[0]:
+                            ultimas[clave] = (version, operacion, fila)
+
+                vigentes = [fila for version, operacion, fila in ultimas.values() if operacion != 'REMOVE']
+                escritor_csv.writerows(vigentes)
+                acumular_estadisticas(estadisticas, vigentes)
+
+        prefijo_snapshot = nuevo_prefijo_version(stage)
+        s3.upload_file(archivo_snapshot, nombre_bucket, f"{prefijo_snapshot}{archivo_csv}")
+
+    manifiesto = escribir_manifiesto(nombre_bucket, f"{prefijo_snapshot}{archivo_csv}", estadisticas)
+    actualizar_ubicacion_glue(glue_database, glue_table_name, f"s3://{nombre_bucket}/{prefijo_snapshot}",
+                              parametros_estadisticas(estadisticas, manifiesto))
+    borrar_objetos_s3(nombre_bucket, [objeto['Key'] for objeto in objetos_deltas])
+    podar_versiones(nombre_bucket, stage, prefijo_snapshot, args.versiones_retenidas)
+    print(f"Snapshot de {estadisticas['filas']} filas publicado en s3://{nombre_bucket}/{prefijo_snapshot}")
+    return True
+
+
+def hash_clave(clave):
+    """Huella de 64 bits de una clave primaria (tupla de strings)."""
+    return int.from_bytes(hashlib.blake2b('\x1f'.join(clave).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def registrar_claves(registro, filas):
+    """Agrega al registro temporal una línea 'huella<TAB>clave JSON' por fila.
+
+    La huella va en hexadecimal de ancho fijo, así que el orden de las líneas es el orden de las huellas.
+    """
+    for fila in filas:
+        clave = tuple(str(fila[i]) for i in COLUMNAS_CLAVE)
+        registro.write(f"{hash_clave(clave):016x}\t{json.dumps(clave, ensure_ascii=False)}\n")
+
+
+def ordenar_registro_claves(registro, directorio, memoria_mb):
+    """Ordena el registro de claves en disco y devuelve sus líneas sin repetir.
+
+    Se ordenan tramos que caben en `memoria_mb`, se escriben a archivos y se mezclan con heapq.merge.
+    """
+    registro.seek(0)
+    tramos = []
+    while True:
+        # Cada línea ocupa en memoria varias veces su largo en el archivo
+        lineas = registro.readlines(memoria_mb * 1024 * 1024 // 4)
+        if not lineas:
+            break
+        lineas.sort()
+        tramos.append(os.path.join(directorio, f"tramo-{len(tramos)}"))
+        with open(tramos[-1], 'w', encoding='utf-8') as archivo:
+            archivo.writelines(lineas)
+        del lineas
+
+    archivos = [open(tramo, encoding='utf-8') for tramo in tramos]
+    try:
+        anterior = None
+        for linea in heapq.merge(*archivos):
+            if linea != anterior:
+                yield linea
+                anterior = linea
+    finally:
+        for archivo in archivos:
+            archivo.close()
+
+
+def construir_indice_claves(registro, directorio, memoria_mb):
+    """Escribe en `directorio` el índice de claves ordenado por huella. Devuelve (ruta de huellas, ruta de claves, total).
+
+    El índice son dos archivos alineados: las huellas como un arreglo de
+    enteros de 64 bits y las claves en JSON, una por línea, en el mismo orden.
+    """
+    ruta_hashes = os.path.join(directorio, 'claves.hashes')
+    ruta_claves = os.path.join(directorio, 'claves.jsonl')
+    total = 0
+    with open(ruta_hashes, 'wb') as archivo_hashes, open(ruta_claves, 'w', encoding='utf-8') as archivo_claves:
+        huellas = array('Q')
+        for linea in ordenar_registro_claves(registro, directorio, memoria_mb):
+            huella, clave = linea.split('\t', 1)
+            huellas.append(int(huella, 16))
+            archivo_claves.write(clave)
+            total += 1
+            if len(huellas) >= 65536:
+                huellas.tofile(archivo_hashes)
+                huellas = array('Q')
+        huellas.tofile(archivo_hashes)
+    return ruta_hashes, ruta_claves, total
+
+
+def guardar_indice_claves(nombre_bucket, stage, registro, directorio=None):
+    """Guarda en S3 el índice de claves del registro (se construye en `directorio` si ya se armó ahí)."""
+    prefijo = f"indices/rooms/{stage}/"
+    with tempfile.TemporaryDirectory() as temporal:
+        directorio = directorio or temporal
+        ruta_hashes = os.path.join(directorio, 'claves.hashes')
+        ruta_claves = os.path.join(directorio, 'claves.jsonl')
+        if not os.path.exists(ruta_hashes):
+            ruta_hashes, ruta_claves, _ = construir_indice_claves(registro, directorio, args.memoria_mb)
+        total = os.path.getsize(ruta_hashes) // 8
+
+        s3.upload_file(ruta_hashes, nombre_bucket, f"{prefijo}claves.hashes")
+        s3.upload_file(ruta_claves, nombre_bucket, f"{prefijo}claves.jsonl")
+
+    print(f"Índice de {total} claves guardado en s3://{nombre_bucket}/{prefijo}")
+
+
+def cargar_indice_claves(nombre_bucket, stage, directorio):
+    """Descarga el índice de la ejecución anterior. Devuelve (huellas, ruta de claves) o (None, None)."""
+    prefijo = f"indices/rooms/{stage}/"
+    ruta_hashes = os.path.join(directorio, 'claves.hashes')
+    ruta_claves = os.path.join(directorio, 'claves.jsonl')
+
+    try:
+        s3.download_file(nombre_bucket, f"{prefijo}claves.hashes", ruta_hashes)
+        s3.download_file(nombre_bucket, f"{prefijo}claves.jsonl", ruta_claves)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None, None
+        raise
+
+    huellas = array('Q')
+    with open(ruta_hashes, 'rb') as archivo:
+        huellas.frombytes(archivo.read())
+    return huellas, ruta_claves
+
+
+def escanear_claves(tabla_dynamo, registro, workers=1):
+    """Scan proyectado solo a los atributos de clave. Escribe las claves de las filas del CSV en el registro."""
+    lock_claves = threading.Lock()
+    nombres = {f"#a{i}": atributo for i, atributo in enumerate(ATRIBUTOS_CLAVE)}
+
+    def escanear_segmento(segmento):
+        scan_kwargs = {'TableName': tabla_dynamo, 'ProjectionExpression': ', '.join(nombres), 'ExpressionAttributeNames': nombres}
+        if workers > 1:
+            scan_kwargs['Segment'] = segmento
+            scan_kwargs['TotalSegments'] = workers
+
+        while True:
+            respuesta = dynamodb_cliente.scan(**scan_kwargs)
+            filas = [fila for item in respuesta['Items'] for fila in construir_filas(deserializar_item(item))]
+            with lock_claves:
+                registrar_claves(registro, filas)
+
+            if 'LastEvaluatedKey' in respuesta:
+                scan_kwargs['ExclusiveStartKey'] = respuesta['LastEvaluatedKey']
+            else:
+                break
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(escanear_segmento, range(workers)))
+
+
+def detectar_borrados(stage, nombre_bucket, workers=1):
+    """Publica tombstones (REMOVE) para las claves del índice anterior que ya no están en DynamoDB.
+
+    Solo se leen los atributos de clave, y la comparación recorre en orden
+    las huellas del índice anterior y las actuales, sin reescribir la tabla.
+    """
+    tabla_dynamo, _, _, _ = nombres_stage(stage)
+    print(f"Detectando borrados en {tabla_dynamo}...")
+    inicio_ms = int(time.time() * 1000)
+
+    borrados = []
+    with tempfile.TemporaryDirectory() as directorio, tempfile.TemporaryFile('w+', encoding='utf-8') as registro:
+        # El índice actual se arma en disco; en memoria solo quedan sus huellas (8 bytes por clave)
+        directorio_actual = os.path.join(directorio, 'actual')
+        os.mkdir(directorio_actual)
+        escanear_claves(tabla_dynamo, registro, workers)
+        ruta_hashes, _, _ = construir_indice_claves(registro, directorio_actual, args.memoria_mb)
+        huellas_actuales = array('Q')
+        with open(ruta_hashes, 'rb') as archivo:
+            huellas_actuales.frombytes(archivo.read())
+
+        huellas_anteriores, ruta_claves = cargar_indice_claves(nombre_bucket, stage, directorio)
+        if huellas_anteriores is None:
+            print("No hay un índice anterior; se crea sin detectar borrados.")
+        else:
+            j = 0
+            with open(ruta_claves, encoding='utf-8') as archivo:
+                for huella, linea in zip(huellas_anteriores, archivo):
+                    while j < len(huellas_actuales) and huellas_actuales[j] < huella:
+                        j += 1
+                    if j == len(huellas_actuales) or huellas_actuales[j] != huella:
+                        borrados.append(json.loads(linea))
+
+        if borrados:
+            # La versión del tombstone es el inicio del scan: cualquier cambio posterior del stream gana
+            version = f"{inicio_ms:015d}-{0:040d}"
+            filas = []
+            for clave in borrados:
+                fila = [''] * len(COLUMNAS_CSV)
+                for i, valor in zip(COLUMNAS_CLAVE, clave):
+                    fila[i] = valor
+                filas.append(fila + ['REMOVE', version])
+            archivo_s3 = publicar_delta(nombre_bucket, stage, filas)
+            print(f"{len(borrados)} borrados publicados en s3://{nombre_bucket}/{archivo_s3}")
+        else:
+            print("No se detectaron borrados.")
+
+        # El índice nuevo se guarda después de publicar los tombstones para no perderlos si algo falla
+        guardar_indice_claves(nombre_bucket, stage, registro, directorio_actual)
+
+
 def crear_base_de_datos_en_glue(glue_database):
     """Crear base de datos en Glue si no existe."""
+    with lock_glue:
+        if glue_database in catalogo_glue:
+            return True
     try:
         glue.get_database(Name=glue_database)
         print(f"La base de datos {glue_database} ya existe.")
@@ -118,59 +1352,193 @@ def crear_base_de_datos_en_glue(glue_database):
     except Exception as e:
         print(f"Error al verificar o crear la base de datos en Glue: {e}")
         return False
+    with lock_glue:
+        catalogo_glue.add(glue_database)
     return True
 
 
-def registrar_datos_en_glue(glue_database, glue_table_name, nombre_bucket, archivo_csv):
+def registrar_tabla_glue(glue_database, table_input):
+    """Crea la tabla en Glue o la actualiza si ya existe. Devuelve True si ya existía.
+
+    Las tablas vistas antes en esta ejecución van directo a update_table, sin el intento de create_table.
+    """
+    clave = (glue_database, table_input['Name'])
+    with lock_glue:
+        existia = clave in catalogo_glue
+    if not existia:
+        try:
+            glue.create_table(DatabaseName=glue_database, TableInput=table_input)
+        except glue.exceptions.AlreadyExistsException:
+            existia = True
+    if existia:
+        glue.update_table(DatabaseName=glue_database, TableInput=table_input)
+    with lock_glue:
+        catalogo_glue.add(clave)
+    return existia
+
+
+def registrar_datos_en_glue(glue_database, glue_table_name, nombre_bucket, archivo_csv, prefijo, parametros=None):
     """Registrar datos en Glue Data Catalog."""
     print(f"Registrando datos en Glue Data Catalog...")
-    input_path = f"s3://{nombre_bucket}/rooms/"
+    input_path = f"s3://{nombre_bucket}/{prefijo}"
 
-    try:
-        glue.create_table(
-            DatabaseName=glue_database,
-            TableInput={
-                'Name': glue_table_name,
-                'StorageDescriptor': {
-                    'Columns': [
-                        {'Name': 'tenant_id', 'Type': 'string'},
-                        {'Name': 'room_id', 'Type': 'string'},
-                        {'Name': 'room_name', 'Type': 'string'},
-                        {'Name': 'max_persons', 'Type': 'int'},
-                        {'Name': 'room_type', 'Type': 'string'},
-                        {'Name': 'price_per_night', 'Type': 'string'},
-                        {'Name': 'description', 'Type': 'string'},
-                        {'Name': 'availability', 'Type': 'string'},
-                        {'Name': 'created_at', 'Type': 'timestamp'},
-                        {'Name': 'image', 'Type': 'string'}
-                    ],
-                    'Location': input_path,
-                    'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
-                    'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
-                    'Compressed': False,
-                    'SerdeInfo': {
-                        'SerializationLibrary': 'org.apache.hadoop.hive.serde2.lazy.LazySimpleSerDe',
-                        'Parameters': {'field.delim': ','}
-                    }
-                },
-                'TableType': 'EXTERNAL_TABLE',
-                'Parameters': {'classification': 'csv'}
+    table_input = {
+        'Name': glue_table_name,
+        'StorageDescriptor': {
+            'Columns': COLUMNAS_GLUE,
+            'Location': input_path,
+            'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
+            'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
+            'Compressed': False,
+            'SerdeInfo': {
+                'SerializationLibrary': 'org.apache.hadoop.hive.serde2.lazy.LazySimpleSerDe',
+                'Parameters': {'field.delim': ','}
             }
-        )
-        print(f"Tabla {glue_table_name} registrada exitosamente en la base de datos {glue_database}.")
+        },
+        'TableType': 'EXTERNAL_TABLE',
+        'Parameters': {'classification': 'csv'}
+    }
+    table_input['Parameters'].update(parametros or {})  # Estadísticas del archivo (recordCount, min/max, ...)
+
+    try:
+        # Si la tabla ya existe, la nueva ubicación se publica con una sola llamada a update_table
+        if registrar_tabla_glue(glue_database, table_input):
+            print(f"Tabla {glue_table_name} actualizada en la base de datos {glue_database}.")
+        else:
+            print(f"Tabla {glue_table_name} registrada exitosamente en la base de datos {glue_database}.")
     except Exception as e:
         print(f"Error al registrar la tabla en Glue: {e}")
+        return False
+    return True
 
 
-if __name__ == "__main__":
+def solicitar_parada(senal, frame):
+    print(f"Señal {signal.Signals(senal).name} recibida: se publica el último lote y se detiene.")
+    parada_solicitada.set()
+
+
+def registrar_deltas_en_glue(stage, nombre_bucket):
+    """Registra los deltas del stage como una tabla de Glue propia (una sola vez por ejecución).
+
+    Tiene las columnas de la tabla más `operacion` (INSERT/MODIFY/REMOVE) y `version`, así que
+    los cambios del stream se consultan en Athena sin esperar a --compactar: el estado vigente
+    de una clave es su fila de mayor `version` en los deltas o, si no tiene deltas, la del snapshot.
+    """
+    _, _, glue_database, glue_table_name = nombres_stage(stage)
+    nombre_deltas = glue_table_name.replace('-table', '-deltas-table')
+    with lock_glue:
+        if (glue_database, nombre_deltas) in catalogo_glue:
+            return True
+    if not crear_base_de_datos_en_glue(glue_database):
+        return False
+
+    table_input = {
+        'Name': nombre_deltas,
+        'StorageDescriptor': {
+            'Columns': COLUMNAS_GLUE + [
+                {'Name': 'operacion', 'Type': 'string'},
+                {'Name': 'version', 'Type': 'string'},
+            ],
+            'Location': f"s3://{nombre_bucket}/deltas/rooms/{stage}/",
+            'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
+            'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
+            'Compressed': False,
+            'SerdeInfo': {
+                'SerializationLibrary': 'org.apache.hadoop.hive.serde2.lazy.LazySimpleSerDe',
+                'Parameters': {'field.delim': ','}
+            }
+        },
+        'TableType': 'EXTERNAL_TABLE',
+        'Parameters': {'classification': 'csv'}
+    }
+    try:
+        registrar_tabla_glue(glue_database, table_input)
+    except Exception as e:
+        print(f"Error al registrar la tabla de deltas en Glue: {e}")
+        return False
+    print(f"Tabla de deltas {nombre_deltas} registrada en la base de datos {glue_database}.")
+    return True
+
+
+def procesar_stage(stage, nombre_bucket):
+    """Ejecuta la exportación completa de un stage hacia su bucket."""
+    if args.cdc:
+        consumir_stream(stage, nombre_bucket, args.cdc_intervalo, args.cdc_max_filas, args.cdc_duracion)
+        return
+
+    if args.rollback:
+        revertir_version(stage, nombre_bucket)
+        return
+
+    if args.detectar_borrados:
+        detectar_borrados(stage, nombre_bucket, args.workers_por_stage)
+        return
+
+    if args.compactar:
+        compactar_deltas(stage, nombre_bucket, args.memoria_mb)
+        return
+
+    if args.tenant:
+        # Modo tenant: Query por tenant_id, sin tocar la tabla de Glue del stage
+        exportar_tenants(stage, nombre_bucket, args.tenant, args.workers_por_stage)
+        return
+
+    tabla_dynamo, archivo_csv, glue_database, glue_table_name = nombres_stage(stage)
+
     if crear_base_de_datos_en_glue(glue_database):
-        exportar_dynamodb_a_csv(tabla_dynamo, archivo_csv)
+        inicio_export = time.time()
+        # Las claves exportadas van a un archivo temporal; el índice se ordena en disco al final
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as claves_exportadas:
+            try:
+                estadisticas = exportar_dynamodb_a_csv(tabla_dynamo, archivo_csv, args.workers_por_stage, claves_exportadas, nombre_bucket)
+            finally:
+                # Libera los workers de la tabla para que el planificador los reasigne
+                marcar_tabla_terminada(tabla_dynamo)
 
-        if subir_csv_a_s3(archivo_csv, nombre_bucket):
-            registrar_datos_en_glue(glue_database, glue_table_name, nombre_bucket, archivo_csv)
-        else:
-            print("No se pudo completar el proceso porque hubo un error al subir el archivo a S3.")
+            # Cada ejecución escribe en su propia versión; los lectores siguen viendo la anterior
+            # hasta que la Location de Glue cambia en una sola llamada
+            prefijo_version = nuevo_prefijo_version(stage)
+
+            if subir_csv_a_s3(archivo_csv, nombre_bucket, prefijo_version):
+                manifiesto = escribir_manifiesto(nombre_bucket, f"{prefijo_version}{archivo_csv}", estadisticas)
+                if registrar_datos_en_glue(glue_database, glue_table_name, nombre_bucket, archivo_csv, prefijo_version,
+                                           parametros_estadisticas(estadisticas, manifiesto)):
+                    podar_versiones(nombre_bucket, stage, prefijo_version, args.versiones_retenidas)
+                    purgar_deltas_anteriores(nombre_bucket, stage, inicio_export)
+                    guardar_indice_claves(nombre_bucket, stage, claves_exportadas)
+            else:
+                print("No se pudo completar el proceso porque hubo un error al subir el archivo a S3.")
     else:
         print("Error en la creación de la base de datos Glue. No se continuará con el proceso.")
 
+
+if __name__ == "__main__":
+    if args.profile:
+        pilas = Counter()
+        detener_perfil = threading.Event()
+        muestreador = threading.Thread(target=muestrear_pilas, args=(args.profile_intervalo / 1000, detener_perfil, pilas), daemon=True)
+        muestreador.start()
+        inicio_perfil = time.perf_counter()
+
+    if args.cdc:
+        # Los consumidores corren en hilos del pool: las señales solo llegan al hilo principal
+        signal.signal(signal.SIGINT, solicitar_parada)
+        signal.signal(signal.SIGTERM, solicitar_parada)
+
+    # Todos los stages comparten los clientes (y su pool de conexiones) y la caché de Glue
+    # En modo --cdc cada stage consume su stream sin terminar, así que todos corren a la vez
+    with ThreadPoolExecutor(max_workers=len(stages) if args.cdc else args.max_stages) as executor:
+        futuros = {executor.submit(procesar_stage, stage, nombre_bucket): stage for stage, nombre_bucket in stages}
+        for futuro, stage in futuros.items():
+            try:
+                futuro.result()
+            except Exception as e:
+                print(f"Error procesando el stage {stage}: {e}")
+
+    if args.profile:
+        detener_perfil.set()
+        muestreador.join()
+        escribir_perfil(args.profile_dir, pilas, time.perf_counter() - inicio_perfil)
+        subir_perfil(args.profile_dir, stages[0][1])
+
     print("Proceso completado.")
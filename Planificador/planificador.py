@@ -0,0 +1,137 @@
+import boto3
+import json
+import math
+import os
+import time
+import argparse
+
+# Configuración de argparse para obtener parámetros
+parser = argparse.ArgumentParser(description='Planificador global de workers y RCU para las seis ingestas')
+
+# Se aceptan los mismos argumentos que las ingestas; los que no usa el planificador (--bucket) se ignoran
+parser.add_argument('--stage', required=True, action='append', help="Indica el stage (por ejemplo, dev, prod). Se puede repetir")
+parser.add_argument('--workers-totales', type=int, default=24, help="Segmentos de scan en paralelo entre todas las tablas")
+parser.add_argument('--rcu-totales', type=int, default=0, help="RCU por segundo entre todas las tablas (0 = sin límite)")
+parser.add_argument('--bytes-por-segmento', type=int, default=64 * 1024 * 1024, help="Tamaño aproximado de cada segmento de scan")
+parser.add_argument('--plan-dir', default='/plan', help="Directorio compartido con las ingestas donde se escribe plan.json")
+parser.add_argument('--intervalo', type=int, default=2, help="Segundos entre revisiones de las tablas terminadas")
+parser.add_argument('--endpoint-url-dynamodb', help="Endpoint alternativo para DynamoDB (por ejemplo, DynamoDB Local)")
+
+args, _ = parser.parse_known_args()
+
+# Tablas de las seis ingestas, en el mismo orden que run_all.sh
+TABLAS = ['hotel-users', 'hotel-services', 'hotel-rooms', 'hotel-reservations', 'hotel-comments', 'hotel-payments']
+
+dynamodb_cliente = boto3.client('dynamodb', region_name='us-east-1', endpoint_url=args.endpoint_url_dynamodb)
+
+
+def medir_tablas():
+    """Tamaño en bytes e ítems de cada tabla según DescribeTable (lo actualiza DynamoDB cada ~6 horas)."""
+    tamanos = {}
+    for stage in args.stage:
+        for tabla in TABLAS:
+            tabla_dynamo = f'{stage}-{tabla}'
+            try:
+                descripcion = dynamodb_cliente.describe_table(TableName=tabla_dynamo)['Table']
+            except Exception as e:
+                print(f"No se pudo describir la tabla {tabla_dynamo}: {e}")
+                continue
+            tamanos[tabla_dynamo] = {'bytes': descripcion.get('TableSizeBytes', 0), 'items': descripcion.get('ItemCount', 0)}
+    return tamanos
+
+
+def repartir(total, pesos, minimo):
+    """Reparte un total entero en proporción a los pesos (mínimo por tabla y mayor resto)."""
+    if not pesos:
+        return {}
+    if not sum(pesos.values()):
+        # Tablas vacías o sin tamaño publicado todavía: partes iguales
+        pesos = {tabla: 1 for tabla in pesos}
+    disponible = max(0, total - minimo * len(pesos))
+    cuotas = {tabla: disponible * peso / sum(pesos.values()) for tabla, peso in pesos.items()}
+    asignado = {tabla: minimo + int(cuota) for tabla, cuota in cuotas.items()}
+    sobrante = total - sum(asignado.values())
+    for tabla in sorted(cuotas, key=lambda t: cuotas[t] - int(cuotas[t]), reverse=True)[:max(0, sobrante)]:
+        asignado[tabla] += 1
+    return asignado
+
+
+def armar_plan(tamanos):
+    # Si hay más tablas que workers (o que RCU), corren primero las más grandes con al menos 1 de
+    # cada uno; las demás quedan en cola con 0 hasta que reasignar les pasa lo de una tabla terminada
+    capacidad = min(args.workers_totales, args.rcu_totales or args.workers_totales)
+    activas = sorted(tamanos, key=lambda tabla: tamanos[tabla]['bytes'], reverse=True)[:max(1, capacidad)]
+    pesos = {tabla: tamanos[tabla]['bytes'] for tabla in activas}
+    workers = repartir(args.workers_totales, pesos, 1)
+    rcu = repartir(args.rcu_totales, pesos, 1) if args.rcu_totales else {}
+    plan = {'workers_totales': args.workers_totales, 'tablas': {}}
+    for tabla, tamano in tamanos.items():
+        # Más segmentos que workers: los workers libres toman segmentos pendientes
+        segmentos = max(workers.get(tabla, 1), min(1000, math.ceil(tamano['bytes'] / args.bytes_por_segmento)))
+        plan['tablas'][tabla] = {
+            'workers': workers.get(tabla, 0),
+            'rcu': rcu.get(tabla, 0),
+            'segmentos': segmentos,
+            'bytes': tamano['bytes'],
+            'items': tamano['items'],
+        }
+    return plan
+
+
+def escribir_plan(plan):
+    # Se escribe a un temporal y se reemplaza, para que las ingestas nunca lean un plan a medias
+    ruta = os.path.join(args.plan_dir, 'plan.json')
+    with open(ruta + '.tmp', 'w') as archivo:
+        json.dump(plan, archivo, indent=2)
+    os.replace(ruta + '.tmp', ruta)
+
+
+def tabla_terminada(tabla_dynamo):
+    return os.path.exists(os.path.join(args.plan_dir, f"terminado-{tabla_dynamo}"))
+
+
+def reasignar(plan, terminadas):
+    """Pasa los workers y las RCU de las tablas terminadas a la tabla en cola más grande o, si no hay, a la más grande que sigue corriendo."""
+    pendientes = [tabla for tabla in plan['tablas'] if tabla not in terminadas]
+    if not pendientes:
+        return False
+    cambio = False
+    for tabla in terminadas:
+        asignacion = plan['tablas'][tabla]
+        if not asignacion['workers'] and not asignacion['rcu']:
+            continue
+        en_cola = [t for t in pendientes if not plan['tablas'][t]['workers']]
+        destino = max(en_cola or pendientes, key=lambda t: plan['tablas'][t]['bytes'])
+        plan['tablas'][destino]['workers'] += asignacion['workers']
+        plan['tablas'][destino]['rcu'] += asignacion['rcu']
+        print(f"{tabla} terminó: {asignacion['workers']} workers pasan a {destino}")
+        asignacion['workers'] = 0
+        asignacion['rcu'] = 0
+        cambio = True
+    return cambio
+
+
+if __name__ == "__main__":
+    os.makedirs(args.plan_dir, exist_ok=True)
+
+    # Las marcas de una ejecución anterior no cuentan
+    for nombre in os.listdir(args.plan_dir):
+        if nombre.startswith('terminado-'):
+            os.remove(os.path.join(args.plan_dir, nombre))
+
+    plan = armar_plan(medir_tablas())
+    escribir_plan(plan)
+    for tabla, asignacion in plan['tablas'].items():
+        if not asignacion['workers']:
+            print(f"{tabla}: en cola hasta que termine otra tabla")
+            continue
+        print(f"{tabla}: {asignacion['workers']} workers, {asignacion['segmentos']} segmentos, {asignacion['rcu'] or 'sin límite de'} RCU")
+
+    terminadas = set()
+    while len(terminadas) < len(plan['tablas']):
+        time.sleep(args.intervalo)
+        terminadas = {tabla for tabla in plan['tablas'] if tabla_terminada(tabla)}
+        if reasignar(plan, terminadas):
+            escribir_plan(plan)
+
+    print("Todas las tablas terminaron. Planificador detenido.")
@@ -1,8 +1,14 @@
 #!/bin/bash
 
-# Solicitar al usuario el stage y el bucket
-read -p "Ingrese el stage (por ejemplo, dev, test, prod): " stage
-read -p "Ingrese el nombre del bucket de S3: " bucket
+# Los pares stage/bucket se pueden pasar como argumentos, por ejemplo:
+#   ./run_all.sh --stage dev --bucket bucket-dev --stage prod --bucket bucket-prod
+# Si no se pasa ninguno, se solicitan al usuario
+argumentos=("$@")
+if [ ${#argumentos[@]} -eq 0 ]; then
+  read -p "Ingrese el stage (por ejemplo, dev, test, prod): " stage
+  read -p "Ingrese el nombre del bucket de S3: " bucket
+  argumentos=(--stage "$stage" --bucket "$bucket")
+fi
 
 # Definir las carpetas y las imágenes Docker (diccionario)
 declare -A carpetas
@@ -15,26 +21,55 @@ carpetas=(
     ["Ingesta6"]="ingesta6"
 )
 
-# Recorrer todas las carpetas del diccionario
+credenciales="/home/ubuntu/.aws/credentials:/root/.aws/credentials"
+
+# Directorio compartido entre el planificador y las ingestas (plan.json y marcas de tablas terminadas)
+dir_plan="$(pwd)/plan"
+mkdir -p "$dir_plan"
+rm -f "$dir_plan/plan.json"
+
+# Construir todas las imágenes antes de correr nada
+echo "Construyendo la imagen Docker del planificador..."
+docker build -t planificador Planificador
 for carpeta in "${!carpetas[@]}"; do
   imagen="${carpetas[$carpeta]}" # Obtener el nombre de la imagen correspondiente
-
   echo "Construyendo la imagen Docker para $carpeta (imagen: $imagen)..."
+  docker build -t $imagen $carpeta
+done
 
-  # Cambiar al directorio de la carpeta correspondiente
-  cd $carpeta
-
-  # Construir la imagen Docker
-  docker build -t $imagen .
+# El planificador reparte los workers y las RCU según el tamaño de cada tabla
+echo "Iniciando el planificador..."
+# Sin --rm: si el planificador muere, sus logs siguen disponibles para diagnosticar
+docker rm -f planificador > /dev/null 2>&1
+docker run -d --name planificador -v $credenciales -v "$dir_plan":/plan planificador "${argumentos[@]}"
+espera_plan=120
+while [ ! -f "$dir_plan/plan.json" ]; do
+  if [ -z "$(docker ps -q -f name=^planificador$)" ] && [ ! -f "$dir_plan/plan.json" ]; then
+    echo "El planificador terminó sin escribir plan.json. Logs:"
+    docker logs planificador
+    exit 1
+  fi
+  if [ $espera_plan -le 0 ]; then
+    echo "Tiempo de espera agotado: el planificador no escribió plan.json. Logs:"
+    docker logs planificador
+    docker rm -f planificador > /dev/null 2>&1
+    exit 1
+  fi
+  espera_plan=$((espera_plan - 1))
+  sleep 1
+done
 
-  # Ejecutar el contenedor Docker con los argumentos --stage y --bucket
+# Las seis ingestas corren a la vez y comparten el presupuesto del plan
+for carpeta in "${!carpetas[@]}"; do
+  imagen="${carpetas[$carpeta]}"
   echo "Corriendo el contenedor para $carpeta con la imagen $imagen..."
-  docker run -v /home/ubuntu/.aws/credentials:/root/.aws/credentials $imagen --stage "$stage" --bucket "$bucket"
-
-  # Volver al directorio anterior
-  cd ..
-
-  echo "Proceso completado para $carpeta."
+  docker run -v $credenciales -v "$dir_plan":/plan $imagen "${argumentos[@]}" --plan /plan/plan.json &
 done
+wait
+
+# Si alguna ingesta falló antes de marcar su tabla, el planificador sigue esperando: se detiene aquí
+docker stop planificador > /dev/null 2>&1
+docker logs planificador > "$dir_plan/planificador.log" 2>&1
+docker rm planificador > /dev/null 2>&1
 
 echo "¡Todos los procesos de build y run han sido completados!"